@@ -3,49 +3,109 @@ import logging
 import random
 import time
 import threading
-import weakref
 from queue import Queue, Empty
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import h5py
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+try:
+    import blosc2
+except ImportError:
+    blosc2 = None
 
 import fixpath
 import carla
 
+#Blueprint lists are filtered once per process; every library query and attribute read is an RPC into the simulator
+_vehicle_bps = None
+_walker_bps = None
+
+def _get_vehicle_blueprints(bp_lib):
+    global _vehicle_bps
+    if _vehicle_bps is None:
+        blueprints = bp_lib.filter('vehicle')
+        blueprints = [x for x in blueprints if int(x.get_attribute('number_of_wheels')) == 4]
+        _vehicle_bps = [x for x in blueprints if not x.id.endswith(('isetta','carlacola','cybertruck','t2'))]
+    return _vehicle_bps
+
+def _get_walker_blueprints(bp_lib):
+    global _walker_bps
+    if _walker_bps is None:
+        _walker_bps = list(bp_lib.filter('walker.pedestrian.*'))
+    return _walker_bps
+
+class SpscRing:
+    '''Single-producer/single-consumer ring buffer. The GIL makes the index increments atomic, so put/get take no locks on the hot path; an Event is only used to sleep while the ring is empty'''
+
+    def __init__(self, capacity=16):
+        self.buffer = [None] * capacity
+        self.capacity = capacity
+        self.head = 0 #next write slot, incremented only by the producer
+        self.tail = 0 #next read slot, incremented only by the consumer
+        self.ready = threading.Event()
+
+    def put(self, item):
+        while self.head - self.tail >= self.capacity:
+            time.sleep(0) #ring full, yield until the consumer catches up
+        self.buffer[self.head % self.capacity] = item
+        self.head += 1
+        self.ready.set()
+
+    def get(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.head == self.tail:
+            self.ready.clear()
+            if self.head != self.tail: #producer raced the clear, data is available
+                break
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if (remaining is not None and remaining <= 0) or not self.ready.wait(remaining):
+                raise Empty
+        item = self.buffer[self.tail % self.capacity]
+        self.buffer[self.tail % self.capacity] = None #drop the reference so the payload can be reclaimed
+        self.tail += 1
+        return item
+
 class Vehicle:
     '''Creates and spawn a vehicle with a lidar sensor'''
 
-    #Class variable that stores references to all instances
-    instances = []
+    #Class variable that maps actor id -> instance, so individual actors can be removed in O(1)
+    instances = {}
 
     def __init__(self, transform, world, args):
         '''Try to spawn vehicle at given transform, may fail due to collision. If it doesnt, spawns lidar sensor and add object to instances'''
 
         #try to spawn vehicle
         self.world = world
+        self.bp_lib = world.get_blueprint_library() #cache the library handle, every lookup is an RPC into the simulator
         self.vehicle = world.try_spawn_actor(self.get_random_blueprint(), transform)
         if self.vehicle is None:
             return
-        Vehicle.instances.append(self)
         self.vehicle.set_autopilot(args.no_autopilot)
         self.id = self.vehicle.id
-        self.sensorQueue = Queue()
+        Vehicle.instances[self.id] = self
+        self.sensorQueue = SpscRing()
+
+        #cache the bounding box extent (constant per actor but an RPC per access) and the full dimensions as an array
+        self.ext = self.vehicle.bounding_box.extent
+        self.ext_arr = np.array([2*self.ext.x, 2*self.ext.y, 2*self.ext.z], dtype='f4')
 
         #create lidar sensor and registers callback
         #lidar height is the height of the vehicle plus the necessary to avoid any points on the roof of the vehicle given the lower fov angle
-        hp = max(self.vehicle.bounding_box.extent.x,self.vehicle.bounding_box.extent.y)*np.tan(np.radians(-args.lower_fov))
-        lidar_transform = carla.Transform(carla.Location(z=2*self.vehicle.bounding_box.extent.z+hp))
+        hp = max(self.ext.x,self.ext.y)*np.tan(np.radians(-args.lower_fov))
+        lidar_transform = carla.Transform(carla.Location(z=2*self.ext.z+hp))
         self.lidar= world.spawn_actor(self.get_lidar_bp(args), lidar_transform, attach_to=self.vehicle)
         self.lidar.listen(lambda data : self.lidar_callback(data))
 
     def get_random_blueprint(self):
-        blueprints = self.world.get_blueprint_library().filter('vehicle')
-        blueprints = [x for x in blueprints if int(x.get_attribute('number_of_wheels')) == 4]
-        blueprints = [x for x in blueprints if not x.id.endswith(('isetta','carlacola','cybertruck','t2'))]
-        return random.choice(blueprints)
+        return random.choice(_get_vehicle_blueprints(self.bp_lib))
 
     def get_lidar_bp(self, args):
-        lidar_bp = self.world.get_blueprint_library().find('sensor.lidar.ray_cast')
+        lidar_bp = self.bp_lib.find('sensor.lidar.ray_cast')
         lidar_bp.set_attribute('dropoff_general_rate', '0.0')
         lidar_bp.set_attribute('dropoff_intensity_limit', '1.0')
         lidar_bp.set_attribute('dropoff_zero_intensity', '0.0')
@@ -57,34 +117,43 @@ class Vehicle:
         return lidar_bp
 
     def lidar_callback(self, data):
-        points = np.copy(np.frombuffer(data.raw_data, dtype=np.dtype('f4')))
-        point_cloud = np.reshape(points, (int(points.shape[0] / 4), 4))
+        #quantize to float16 at ingest (the dataset dtype) so padding and compression downstream move half the bytes
+        #fp16 max (65504) comfortably covers the lidar range
+        #the subarray dtype views the packet as [N,4] directly, so copy + quantize happen in a single pass
+        points = np.frombuffer(data.raw_data, dtype=np.dtype((np.float32, 4)))
+        point_cloud = np.array(points, dtype=np.float16)
         self.sensorQueue.put((data.frame, point_cloud, data.transform))
 
     def destroy(self):
+        Vehicle.instances.pop(self.id, None)
         self.lidar.destroy()
         self.vehicle.destroy()
 
 class Walker:
     '''Spawns a walker in a given transform of the environment'''
 
-    #Class variable that stores references to all instances
-    instances = []
+    #Class variable that maps actor id -> instance, so individual actors can be removed in O(1)
+    instances = {}
 
     def __init__(self, transform, world, args):
         '''Try to spawn walker in a given transform, if successful adds reference to instance list'''
 
         self.world = world
+        self.bp_lib = world.get_blueprint_library()
 
         #try spawning the actor
         self.walker= world.try_spawn_actor(self.get_random_blueprint(), transform)
         if self.walker is None:
             return
-        Walker.instances.append(self)
         self.id = self.walker.id
+        Walker.instances[self.id] = self
+
+        #cache the bounding box extent as for Vehicle
+        self.ext = self.walker.bounding_box.extent
+        self.ext_arr = np.array([2*self.ext.x, 2*self.ext.y, 2*self.ext.z], dtype='f4')
 
         #spawn a controller for the walker
-        walker_controller_bp = world.get_blueprint_library().find('controller.ai.walker')
+        walker_controller_bp = self.bp_lib.find('controller.ai.walker')
         self.controller = world.spawn_actor(walker_controller_bp, carla.Transform(), self.walker)
 
     def start_controller(self):
@@ -92,28 +161,58 @@ class Walker:
         self.controller.go_to_location(self.world.get_random_location_from_navigation())
 
     def get_random_blueprint(self):
-        blueprints = self.world.get_blueprint_library().filter('walker.pedestrian.*')
-        return random.choice(blueprints)
+        return random.choice(_get_walker_blueprints(self.bp_lib))
 
     def destroy(self):
+        Walker.instances.pop(self.id, None)
         self.controller.stop()
         self.controller.destroy()
         self.walker.destroy()
 
-def transformPts(transform, pts, inverse=False):
-    #split intensity from 3D coordinates, add homogeneus coordinate
-    intensity = pts[:,-1,np.newaxis].copy()
-    pts[:,-1] = 1
+#Cache of transform matrices keyed by pose, so repeated calls for the same lidar pose skip the Python list -> ndarray conversion
+#F-contiguous float32 lets np.matmul dispatch straight to sgemm
+_matrix_cache = {}
+
+def _get_matrix(transform, inverse):
+    loc, rot = transform.location, transform.rotation
+    key = (loc.x, loc.y, loc.z, rot.pitch, rot.yaw, rot.roll, inverse)
+    mat = _matrix_cache.get(key)
+    if mat is None:
+        if len(_matrix_cache) > 1024: #keep the cache bounded over long runs
+            _matrix_cache.clear()
+        mat = np.asfortranarray(np.asarray(transform.get_inverse_matrix() if inverse else transform.get_matrix(), dtype=np.float32))
+        _matrix_cache[key] = mat
+    return mat
 
-    #perform transformation
-    mat = transform.get_inverse_matrix() if inverse else transform.get_matrix()
-    mat = np.array(mat)
-    ptst = np.dot(pts, mat.T)
-
-    #merge intensity back
-    ptst = np.concatenate([ptst[:,:3],intensity], axis=1)
+def transformPts(transform, pts, inverse=False):
+    mat = _get_matrix(transform, inverse).astype(pts.dtype, copy=False)
+
+    #transform the 3D coordinates into a preallocated output, carrying intensity over untouched
+    #applying rotation and translation separately avoids homogenising pts (no copy, no concatenate)
+    ptst = np.empty_like(pts)
+    np.matmul(pts[:,:3], mat[:3,:3].T, out=ptst[:,:3])
+    ptst[:,:3] += mat[:3,3]
+    ptst[:,3] = pts[:,3]
     return ptst
 
+def _pose_row(transform, out):
+    '''Fill a preallocated [x,y,z,pitch,yaw,roll] row in place, avoiding a temporary ndarray per vehicle per frame'''
+    loc, rot = transform.location, transform.rotation
+    out[0] = loc.x
+    out[1] = loc.y
+    out[2] = loc.z
+    out[3] = rot.pitch
+    out[4] = rot.yaw
+    out[5] = rot.roll
+
+def _compress_pcl(buf):
+    '''Compress a frame of point clouds with blosc2 into ready-made chunk bytes for a direct chunk write'''
+    #the hdf5plugin Blosc2 filter stores each HDF5 chunk as a serialized super-chunk cframe, so the payload
+    #must be built with SChunk/to_cframe (a bare compress2 chunk would write fine but fail on read)
+    #typesize must be given explicitly (a bytes buffer carries none) so bitshuffle works on 2-byte fp16 lanes
+    cparams = {'codec': blosc2.Codec.ZSTD, 'clevel': 5, 'filters': [blosc2.Filter.BITSHUFFLE], 'typesize': np.dtype(np.float16).itemsize}
+    return blosc2.SChunk(chunksize=len(buf), data=buf, cparams=cparams).to_cframe()
+
 def main(args):
     try:
         #Load client & world
@@ -138,7 +237,10 @@ def main(args):
         logging.info('Spawning vehicles')
         spawn_points = [waypoint.transform for waypoint in world.get_map().generate_waypoints(5)] # waypoints every x meters 
         sp_choice = random.choice(spawn_points)
-        spawn_points = [sp for sp in spawn_points if sp.location.distance(sp_choice.location) < args.range/2]
+        #filter by distance in a single vectorized pass rather than one location.distance RPC per waypoint
+        coords = np.fromiter(((sp.location.x, sp.location.y, sp.location.z) for sp in spawn_points), dtype=np.dtype((np.float32, 3)))
+        d2 = ((coords - [sp_choice.location.x, sp_choice.location.y, sp_choice.location.z])**2).sum(1)
+        spawn_points = [spawn_points[i] for i in np.nonzero(d2 < (args.range/2)**2)[0]]
         while(len(Vehicle.instances) < args.nvehicles):
             transform = random.choice(spawn_points)
             transform.location.z += 0.3 #avoid colision with ground
@@ -158,13 +260,71 @@ def main(args):
             Walker(carla.Transform(location=location), world, args)
 
         #Create HDF5 file with datasets
-        compression_opts = {'compression':'gzip', 'compression_opts':9}
+        #Blosc(zstd) compresses much faster than gzip-9 at a comparable ratio; fall back to lzf when hdf5plugin is unavailable
+        #Shuffling groups the correlated high-order bytes of the floats together, multiplying the compression ratio at negligible cost
+        #Bit-shuffle works best on the quantized fp16 point clouds, byte-shuffle on the fp32 pose/bbox arrays
+        #point_cloud dominates the file size, so it gets the Blosc2 filter - the same format the direct chunk path produces
+        if hdf5plugin is not None:
+            pcl_opts = dict(hdf5plugin.Blosc2(cname='zstd', clevel=5, filters=hdf5plugin.Blosc2.BITSHUFFLE))
+            compression_opts = dict(hdf5plugin.Blosc(cname='zstd', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+        else:
+            pcl_opts = {'compression':'lzf', 'shuffle':True}
+            compression_opts = {'compression':'lzf', 'shuffle':True}
+
+        #With blosc2 available, point-cloud chunks are compressed off the main thread and written via write_direct_chunk
+        direct_pcl = hdf5plugin is not None and blosc2 is not None
+        if args.save != '':
+            f = h5py.File(args.save, 'w', libver='latest')
+            #Chunk shapes match the write pattern so each write touches exactly one chunk (no decompress-modify-recompress of neighbouring frames)
+            #point_cloud is chunked per frame to line up with the batched frame writes and the direct chunk path
+            f.create_dataset('point_cloud', (args.frames, args.nvehicles, args.points_per_cloud, 4), dtype='float16', chunks=(1, args.nvehicles, args.points_per_cloud, 4), **pcl_opts)
+            f.create_dataset('lidar_pose', (args.frames, args.nvehicles, 6), dtype='float32', chunks=(1, args.nvehicles, 6), **compression_opts)
+            f.create_dataset('vehicle_boundingbox', (args.frames, args.nvehicles, 8), dtype='float32', chunks=(1, args.nvehicles, 8), **compression_opts)
+            f.create_dataset('pedestrian_boundingbox', (args.frames, args.npedestrians, 8), dtype='float32', chunks=(1, args.npedestrians, 8), **compression_opts)
+            f.swmr_mode = True #all writes happen on the writer thread; SWMR keeps the file consistent for concurrent readers
+
+        #Preallocate per-frame staging buffers so each dataset is written in a single assignment per frame
         if args.save != '':
-            f = h5py.File(args.save, 'w')
-            f.create_dataset('point_cloud', (args.frames, args.nvehicles, args.points_per_cloud, 4), dtype='float16', **compression_opts)
-            f.create_dataset('lidar_pose', (args.frames, args.nvehicles, 6), dtype='float32', **compression_opts)
-            f.create_dataset('vehicle_boundingbox', (args.frames, args.nvehicles, 8), dtype='float32', **compression_opts)
-            f.create_dataset('pedestrian_boundingbox', (args.frames, args.npedestrians, 8), dtype='float32', **compression_opts)
+            pcl_frame = np.zeros((args.nvehicles, args.points_per_cloud, 4), dtype=np.float16)
+            pose_frame = np.zeros((args.nvehicles, 6), dtype=np.float32)
+            vbb_frame = np.zeros((args.nvehicles, 8), dtype=np.float32)
+            pbb_frame = np.zeros((args.npedestrians, 8), dtype=np.float32)
+
+            #the extent columns are constant across frames, fill them once at spawn
+            for i, v in enumerate(Vehicle.instances.values()):
+                vbb_frame[i,5:] = v.ext_arr
+            for i, w in enumerate(Walker.instances.values()):
+                pbb_frame[i,5:] = w.ext_arr
+            vbb_ext_z = np.array([v.ext.z for v in Vehicle.instances.values()], dtype=np.float32)
+
+        #Single worker keeps point-cloud compression ordered and off the main thread
+        if args.save != '' and direct_pcl:
+            pcl_compressor = ThreadPoolExecutor(max_workers=1)
+
+        #Writer thread drains completed frames from a bounded queue so a compression or I/O stall never delays world.tick()
+        if args.save != '':
+            write_q = Queue(maxsize=4)
+            write_error = [] #holds the first exception raised on the writer thread, checked by the producer
+            def writer_loop():
+                while True:
+                    item = write_q.get()
+                    if item is None: #sentinel, no more frames coming
+                        break
+                    if write_error:
+                        continue #keep draining after a failure so the producer never blocks on a full queue
+                    try:
+                        frame, pcl_payload, pose, vbb, pbb = item
+                        if direct_pcl:
+                            f['point_cloud'].id.write_direct_chunk((frame, 0, 0, 0), pcl_payload.result())
+                        else:
+                            f['point_cloud'][frame] = pcl_payload
+                        f['lidar_pose'][frame] = pose
+                        f['vehicle_boundingbox'][frame] = vbb
+                        f['pedestrian_boundingbox'][frame] = pbb
+                    except Exception as e:
+                        write_error.append(e)
+            writer = threading.Thread(target=writer_loop, daemon=True)
+            writer.start()
 
         #Event loop
         savedFrames = -args.burn
@@ -174,36 +334,43 @@ def main(args):
 
             #Pedestrian controllers must be started after first tick
             if savedFrames == 1:
-                for w in Walker.instances:
+                for w in Walker.instances.values():
                     w.start_controller()
             
             try:
-                for i, v in enumerate(Vehicle.instances):
-                    s = v.sensorQueue.get(True,5)
-                    pcl = s[1]
-                    transform = s[2]
-
-                    #if burning frames we should not save them
-                    if savedFrames < 0 or args.save == '':
-                        continue
-
-                    #pad pcl with zeros to make sure it has shape [args.points_per_cloud,3]
-                    pcl_pad = np.pad(pcl, ((0, args.points_per_cloud-pcl.shape[0]),(0,0)), mode='constant')
-
-                    #get vehicle transform in the current frame and extent (extent has half the dimensions)
-                    v_transform = snap.find(v.id).get_transform()
-                    v_ext = v.vehicle.bounding_box.extent 
-
-                    #write data to file
-                    f['point_cloud'][savedFrames,i] = pcl_pad
-                    f['lidar_pose'][savedFrames, i] = np.array([transform.location.x,transform.location.y,transform.location.z, transform.rotation.pitch,transform.rotation.yaw,transform.rotation.roll])
-                    f['vehicle_boundingbox'][savedFrames, i] = np.array([v_transform.location.x,v_transform.location.y,v_transform.location.z+v_ext.z,v_transform.rotation.yaw,v_transform.rotation.pitch,2*v_ext.x,2*v_ext.y,2*v_ext.z])
-                for i, w in enumerate(Walker.instances):
-                    if savedFrames < 0 or args.save == '':
-                        continue
-                    w_transform = snap.find(w.id).get_transform()
-                    w_ext = w.walker.bounding_box.extent
-                    f['pedestrian_boundingbox'][savedFrames, i] = np.array([w_transform.location.x,w_transform.location.y,w_transform.location.z,w_transform.rotation.yaw,w_transform.rotation.pitch,2*w_ext.x,2*w_ext.y,2*w_ext.z])
+                #burn frames (or runs without an output file) only need the sensor rings drained - no staging, no simulator lookups
+                if savedFrames < 0 or args.save == '':
+                    for v in Vehicle.instances.values():
+                        v.sensorQueue.get(timeout=5)
+                else:
+                    #re-zero the point-cloud buffer once per frame so shorter clouds keep their zero padding
+                    pcl_frame.fill(0)
+                    for i, v in enumerate(Vehicle.instances.values()):
+                        s = v.sensorQueue.get(timeout=5)
+                        pcl = s[1]
+                        transform = s[2]
+
+                        #copy pcl into the staging buffer; the buffer was zeroed above so the tail is already padded
+                        pcl_frame[i,:pcl.shape[0]] = pcl
+
+                        _pose_row(transform, pose_frame[i])
+
+                    #build the bounding-box location columns in one vectorized pass per actor type
+                    if Vehicle.instances:
+                        vbb_frame[:,:5] = np.array([(t.location.x,t.location.y,t.location.z,t.rotation.yaw,t.rotation.pitch) for t in (snap.find(v.id).get_transform() for v in Vehicle.instances.values())], dtype=np.float32)
+                        vbb_frame[:,2] += vbb_ext_z #the bbox centre sits half the height above the actor location
+                    if Walker.instances:
+                        pbb_frame[:,:5] = np.array([(t.location.x,t.location.y,t.location.z,t.rotation.yaw,t.rotation.pitch) for t in (snap.find(w.id).get_transform() for w in Walker.instances.values())], dtype=np.float32)
+
+                    #write the staged frame to file - one filter-pipeline invocation per dataset instead of one per actor
+                    #snapshot the staging buffers (tobytes/copy) so they can be refilled next frame while the writer drains
+                    if direct_pcl:
+                        pcl_payload = pcl_compressor.submit(_compress_pcl, pcl_frame.tobytes())
+                    else:
+                        pcl_payload = pcl_frame.copy()
+                    if write_error:
+                        raise write_error[0] #abort the run instead of producing frames nobody can write
+                    write_q.put((savedFrames, pcl_payload, pose_frame.copy(), vbb_frame.copy(), pbb_frame.copy()))
             except Empty:
                 logging.error(f'Missing sensor data for frame {snap.frame}!')
             else:
@@ -213,12 +380,20 @@ def main(args):
                 logging.info(f'World frame {snap.frame} burnt, {-savedFrames} to start recording')
             else:
                 logging.info(f'World frame {snap.frame} saved succesfully as frame {savedFrames}')
-            time.sleep(0.01)
+
+        #Flush outstanding frames and stop the writer before declaring the file complete
+        if args.save != '':
+            write_q.put(None)
+            writer.join()
+            if direct_pcl:
+                pcl_compressor.shutdown(wait=True)
+            if write_error:
+                raise write_error[0] #a frame failed to write, surface it instead of reporting success
 
         logging.info(f'Finished saving {args.frames} frames!')
 
     finally:
-        for a in Vehicle.instances + Walker.instances:
+        for a in list(Vehicle.instances.values()) + list(Walker.instances.values()):
             a.destroy()
         Vehicle.instances.clear()
         Walker.instances.clear()
@@ -1,6 +1,10 @@
 import argparse
 import numpy as np
 import h5py
+try:
+    import hdf5plugin #registers the Blosc/Blosc2 filters used to compress the snippets; old gzip files open without it
+except ImportError:
+    hdf5plugin = None
 from mayavi import mlab
 
 def getTransform(x, y, z, pitch, yaw, roll, degrees=True):